@@ -1,25 +1,27 @@
 from setuptools import setup, find_packages
-from codecs import open
-from os import path
+from pathlib import Path
 
 import spinegeneric
 
 # Get the directory where this current file is saved
-here = path.abspath(path.dirname(__file__))
+here = Path(__file__).resolve().parent
 
-with open(path.join(here, 'README.md'), encoding='utf-8') as f:
-    long_description = f.read()
 
-req_path = path.join(here, 'requirements.txt')
-with open(req_path, "r") as f:
-    install_reqs = f.read().strip()
-    install_reqs = install_reqs.split("\n")
+def _read_long_description():
+    return (here / 'README.md').read_text(encoding='utf-8')
+
+
+def _read_install_requires():
+    return (here / 'requirements.txt').read_text(encoding='utf-8').strip().split('\n')
+
 
 setup(
     name='spinegeneric',
     version=spinegeneric.__version__,
     python_requires='>=3.7',
     description='Collection of cli to process data for the Spine Generic project.',
+    long_description=_read_long_description(),
+    long_description_content_type='text/markdown',
     url='https://spine-generic.rtfd.io',
     author='NeuroPoly Lab, Polytechnique Montreal',
     author_email='neuropoly@googlegroups.com',
@@ -30,7 +32,7 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     keywords='',
-    install_requires=install_reqs,
+    install_requires=_read_install_requires(),
     packages=find_packages(exclude=['.git', '.github', '.docs']),
     include_package_data=True,
     package_data={
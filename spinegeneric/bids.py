@@ -9,7 +9,11 @@ def get_subject(file):
     :param file:
     :return: subject
     """
-    return file.split('_')[0]
+    # slice up to the first '_' instead of split, to avoid allocating a list per call
+    try:
+        return file[:file.index('_')]
+    except ValueError:
+        return file
 
 
 def get_contrast(file):
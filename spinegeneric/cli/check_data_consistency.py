@@ -38,8 +38,9 @@ def main():
 
     path_tsv = os.path.join(data_path, 'participants.tsv')
     tsv_file = pd.read_csv(path_tsv, sep='\t')
-    list_subj = [name for name in os.listdir(data_path) if
-                 os.path.isdir(os.path.join(data_path, name)) and name.startswith('sub')]
+    # os.scandir caches the entry type from the directory read, avoiding one stat per entry
+    with os.scandir(data_path) as it:
+        list_subj = [entry.name for entry in it if entry.name.startswith('sub') and entry.is_dir()]
     df = pd.DataFrame(tsv_file)
     list_tsv_participants = df['participant_id'].tolist()
     missing_subjects_tsv = list(set(list_subj) - set(list_tsv_participants))
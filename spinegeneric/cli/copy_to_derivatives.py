@@ -13,7 +13,7 @@ import spinegeneric as sg
 import spinegeneric.utils
 
 
-FOLDER_DERIVATIVES = os.path.join('derivatives', 'labels')
+FOLDER_DERIVATIVES = sg.utils.FOLDER_DERIVATIVES
 
 
 def get_parser():
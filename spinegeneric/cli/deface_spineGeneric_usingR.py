@@ -48,9 +48,10 @@ def main():
     if folder_copy:
         shutil.copytree(input_path, output_path)
     else:
-        for subject in (os.listdir(output_path)):
-            pathSubject = os.path.join(output_path, subject)
-            if os.path.isdir(pathSubject):
+        for entry in os.scandir(output_path):
+            subject = entry.name
+            pathSubject = entry.path
+            if entry.is_dir():
                 for contrast in contrastList:
                     pathContrastDefaced = os.path.join(pathSubject,'anat',subject+'_'+contrast+ '_defaced.nii.gz')
                     pathContrast = os.path.join(pathSubject,'anat',subject+'_'+contrast+ '.nii.gz')
@@ -10,26 +10,27 @@
 
 import os
 import argparse
+import functools
 import importlib.resources
-import tqdm
 import sys
-import csv
 import pandas as pd
-import subprocess
+import re
 from textwrap import dedent
 import yaml
 import math
 
 import numpy as np
 from scipy import ndimage
-from scipy.stats import f_oneway
-from collections import OrderedDict
-from collections import defaultdict
+from scipy.stats import f_oneway, linregress
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import matplotlib
+# Figures are only written to png files: the Agg canvas renders faster than the interactive
+# backends and works headless. Debug mode (-v) switches to TkAgg in generate_figure_metric.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 import matplotlib.patches as patches
-from sklearn.linear_model import LinearRegression
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
 
 import spinegeneric as sg
@@ -259,56 +260,56 @@ def get_parser():
     return parser
 
 
-def aggregate_per_site(dict_results, metric, dict_exclude_subj):
+def aggregate_per_site(df_results, metric, dict_exclude_subj, participants):
     """
     Aggregate metrics per site.
     folder.
-    :param dict_results:
+    :param df_results: DataFrame of the metric csv file (one row per processed file)
     :param metric: Metric type
-    :return:
+    :param participants: Pandas DF of the participants.tsv file (loaded once by the caller)
+    :return: Pandas DF indexed by site, with columns: vendor, model, val, subject
     """
-    # Build Panda DF of participants based on participants.tsv file
-    participants = load_participants_file()
-
     # Fetch specific field for the selected metric
     metric_field = metric_to_field[metric]
-    # Build a dictionary that aggregates values per site
-    results_agg = {}
-    # Loop across lines and fill dict of aggregated results
-    subjects_removed = []
-    for i in tqdm.tqdm(range(len(dict_results)), unit='iter', unit_scale=False, desc="Loop across subjects",
-                       ascii=True, ncols=80):
-        filename = dict_results[i]['Filename']
-        logger.debug('Filename: ' + filename)
-        # Fetch metadata for the site
-        # dataset_description = read_dataset_description(filename, path_data)
-        # cluster values per site
-        subject = fetch_subject(filename)
-        # check if subject needs to be discarded
-        if not remove_subject(subject, metric, dict_exclude_subj):
-            # Fetch index of row corresponding to subject
-            rowIndex = participants[participants['participant_id'] == subject].index
-            # Add column "val" with metric value
-            participants.loc[rowIndex, 'val'] = dict_results[i][metric_field]
-            site = participants['institution_id'][rowIndex].array[0]
-            if not site in results_agg.keys():
-                # if this is a new site, initialize sub-dict
-                results_agg[site] = {}
-                results_agg[site][
-                    'site'] = site  # need to duplicate in order to be able to sort using vendor AND site with Pandas
-                results_agg[site]['vendor'] = participants['manufacturer'][rowIndex].array[0]
-                results_agg[site]['model'] = participants['manufacturers_model_name'][rowIndex].array[0]
-                results_agg[site]['val'] = []
-                results_agg[site]['subject'] = []
-            # add val for site (ignore None)
-            val = dict_results[i][metric_field]
-            if not val == 'None':
-                results_agg[site]['val'].append(float(val))
-                results_agg[site]['subject'].append(subject)
-        else:
-            subjects_removed.append(subject)
-    logger.info("Subjects removed: {}".format(subjects_removed))
-    return results_agg
+
+    # Keep only the columns the aggregation needs (the csv files carry several per-slice
+    # columns that would otherwise be dragged through the filtering and the join below).
+    # Working on this pruned copy also means the writes below never touch a slice.
+    df_results = df_results[['Filename', metric_field]].copy()
+    # vectorized version of fetch_subject(): the subject is the second-to-last folder of the path
+    df_results['subject'] = df_results['Filename'].str.split(os.sep).str[-3]
+    # Coerce metric values to float; non-numeric entries (e.g. 'None') become NaN and are ignored
+    df_results['val'] = pd.to_numeric(df_results[metric_field], errors='coerce')
+
+    # Discard subjects that the user asked to exclude: the per-metric exclusion sets are frozen
+    # by main(), so this is a single hashed isin pass (site entries simply never match a subject)
+    excluded = dict_exclude_subj.get(metric, frozenset())
+    mask_remove = df_results['subject'].isin(excluded)
+    logger.info("Subjects removed: {}".format(df_results['subject'][mask_remove].tolist()))
+    df_results = df_results[~mask_remove]
+
+    # Associate each row with its site metadata through the participant_id index (hash lookups
+    # against the index, built once at load time) instead of re-scanning the participants table
+    # for every row; only the metadata columns used below take part in the join
+    df_results = df_results.join(
+        participants[['institution_id', 'manufacturer', 'manufacturers_model_name']],
+        on='subject', how='inner')
+
+    # Aggregate per site directly into the output DataFrame, preserving the order in which
+    # sites appear in the results (no intermediate per-site dict to convert back in the caller)
+    grouped = df_results.groupby('institution_id', sort=False)
+    df_agg = grouped[['manufacturer', 'manufacturers_model_name']].first()
+    df_agg.columns = ['vendor', 'model']
+    # naming the index lets sort_values mix it with regular columns (e.g. vendor AND site),
+    # so the site does not need to be duplicated into a column of its own
+    df_agg.index.name = 'site'
+    df_valid = df_results.dropna(subset=['val']).groupby('institution_id', sort=False)
+    df_agg['val'] = df_valid['val'].agg(list)
+    df_agg['subject'] = df_valid['subject'].agg(list)
+    # sites whose values were all non-numeric get empty lists (not NaN), as before
+    for column in ('val', 'subject'):
+        df_agg[column] = df_agg[column].apply(lambda x: x if isinstance(x, list) else [])
+    return df_agg
 
 
 def add_stats_per_vendor(ax, x_i, x_j, y_max, mean, std, ci, cov_intra, cov_inter, f, color, show_ci=False):
@@ -350,60 +351,76 @@ def add_stats_per_vendor(ax, x_i, x_j, y_max, mean, std, ci, cov_intra, cov_inte
     return ax
 
 
+def _per_site_stats(vals, offsets):
+    """
+    Per-site mean and population std from a flat value array plus per-site offsets.
+    Kept as a pure-numeric kernel over plain arrays (no pandas objects) so it could be swapped
+    for a JIT-compiled version (e.g. numba) without touching compute_statistics, should the
+    per-site data ever grow beyond what a few reduceat passes handle comfortably.
+    :param vals: float64 array of all values, laid out site by site
+    :param offsets: int array of length n_sites+1 delimiting each site's slice in vals
+    :return: (means, stds): float64 arrays of length n_sites (NaN for empty sites)
+    """
+    lengths = np.diff(offsets)
+    sums = np.zeros(lengths.size)
+    sums_sq = np.zeros(lengths.size)
+    if vals.size:
+        # reduceat segments are delimited by the starts of the non-empty sites (empty sites
+        # would otherwise repeat a boundary, which reduceat does not treat as an empty segment)
+        nonempty = lengths > 0
+        starts = offsets[:-1][nonempty]
+        sums[nonempty] = np.add.reduceat(vals, starts)
+        sums_sq[nonempty] = np.add.reduceat(vals * vals, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / lengths
+        # population std (ddof=0, to match np.std) via E[x^2] - E[x]^2
+        stds = np.sqrt(np.maximum(sums_sq / lengths - means ** 2, 0))
+    return means, stds
+
+
 def compute_statistics(df):
     """
     Compute statistics such as mean, std, COV, etc.
     :param df Pandas structure
     """
-    vendors = ['GE', 'Philips', 'Siemens']
-    mean_per_row = []
-    std_per_row = []
     stats = {}
-    # Compute statistics within site
-    for site in df.index:
-        mean_per_row.append(np.mean(df['val'][site]))
-        std_per_row.append(np.std(df['val'][site]))
-    # Update Dataframe
-    df['mean'] = mean_per_row  # mean within each site (e.g., if there are 35 sites, this will be a vector of length 35)
-    df['std'] = std_per_row
-    df['cov'] = np.array(std_per_row) / np.array(mean_per_row)
-    # Compute intra-vendor COV
-    for vendor in vendors:
-        # init dict
-        if not 'cov_inter' in stats.keys():
-            stats['cov_inter'] = {}
-        if not 'cov_intra' in stats.keys():
-            stats['cov_intra'] = {}
-        if not 'mean' in stats.keys():
-            stats['mean'] = {}
-        if not 'std' in stats.keys():
-            stats['std'] = {}
-        if not '95ci' in stats.keys():
-            stats['95ci'] = {}
-        if not 'anova_site' in stats.keys():
-            stats['anova_site'] = {}
-        # fetch within-site mean values for a specific vendor
-        val_per_vendor = df['mean'][(df['vendor'] == vendor) & ~df['exclude']]
-        # compute mean within vendor (mean of the within-site means)
-        stats['mean'][vendor] = np.mean(val_per_vendor)
-        # compute std within vendor (std of the within-site means)
-        stats['std'][vendor] = np.std(val_per_vendor)
-        # compute 95% confidence interval
-        stats['95ci'][vendor] = 1.96 * np.std(val_per_vendor) / np.sqrt(len(val_per_vendor))
-        # compute within-vendor inter-site COV (based on the within-site means)
-        stats['cov_inter'][vendor] = np.std(val_per_vendor) / np.mean(val_per_vendor)
-        # compute intra-site COV, and average it across all the sites within the same vendor
-        stats['cov_intra'][vendor] = \
-            np.mean(df['std'][(df['vendor'] == vendor) & ~df['exclude']].values /
-                    df['mean'][(df['vendor'] == vendor) & ~df['exclude']].values)
-        # ANOVA: category=[site]
-        values_per_site = [df['val'][(df['vendor'] == vendor) & (df['site'] == i_site)][0]
-                           for i_site in df['site'][(df['vendor'] == vendor) & ~df['exclude']]]
-        stats['anova_site'][vendor] = f_oneway(*values_per_site)
+    # Compute statistics within site: flatten the per-site value lists into one contiguous
+    # array plus per-site offsets, then reduce with a single C pass over the data per
+    # statistic, with no per-site numpy dispatch and no hashing
+    val_lists = [np.asarray(v, dtype=np.float64) for v in df['val']]
+    vals = np.concatenate(val_lists) if val_lists else np.empty(0)
+    offsets = np.concatenate(([0], np.cumsum([v.size for v in val_lists])))
+    # mean within each site (e.g., if there are 35 sites, this will be a vector of length 35)
+    means, stds = _per_site_stats(vals, offsets)
+    df['mean'] = means
+    df['std'] = stds
+    df['cov'] = df['std'] / df['mean']
+    # Compute per-vendor statistics over the non-excluded sites, fused into a single
+    # groupby.agg sweep: within-vendor mean/std of the site means, the site count and the mean
+    # intra-site COV (reusing the per-site 'cov' column) all come out of one grouped pass
+    df_valid = df[~df['exclude']]
+    grouped_vendor = df_valid.groupby('vendor')
+    per_vendor = grouped_vendor.agg(
+        mean=('mean', 'mean'),
+        std=('mean', lambda s: s.std(ddof=0)),
+        n_sites=('mean', 'size'),
+        cov_intra=('cov', 'mean'))
+    stats['mean'] = per_vendor['mean'].to_dict()
+    stats['std'] = per_vendor['std'].to_dict()
+    # 95% confidence interval
+    stats['95ci'] = (1.96 * per_vendor['std'] / np.sqrt(per_vendor['n_sites'])).to_dict()
+    # within-vendor inter-site COV (based on the within-site means)
+    stats['cov_inter'] = (per_vendor['std'] / per_vendor['mean']).to_dict()
+    # intra-site COV, averaged across all the sites within the same vendor
+    stats['cov_intra'] = per_vendor['cov_intra'].to_dict()
+    # ANOVA: category=[site]
+    stats['anova_site'] = {}
+    for vendor, group in grouped_vendor:
+        stats['anova_site'][vendor] = f_oneway(*group['val'].tolist())
         logger.info("ANOVA[site] for {}: {}".format(vendor, stats['anova_site'][vendor]))
 
     # ANOVA: category=[vendor]
-    stats['anova_vendor'] = f_oneway(*[df['mean'][(df['vendor'] == i_vendor) & ~df['exclude']] for i_vendor in vendors])
+    stats['anova_vendor'] = f_oneway(*[group['mean'] for _, group in grouped_vendor])
     logger.info("ANOVA[vendor]: {}".format(stats['anova_vendor']))
     # Multiple pairwise comparison with Tukey Honestly Significant Difference (HSD) test
     stats['tukey_test'] = pairwise_tukeyhsd(df['mean'], df['vendor'])
@@ -515,15 +532,17 @@ def load_participants_file():
     :return: participants: pandas dataframe
     """
     participants = pd.read_csv(os.path.join('participants.tsv'), sep="\t")
-    return participants
+    # index by participant_id once at load: joins and lookups against the index are hashed,
+    # and no caller needs to re-index per call (drop=False keeps the column available)
+    return participants.set_index('participant_id', drop=False)
 
 
-def compute_age_statistics():
+def compute_age_statistics(participants):
     """
     Compute age statistics across subjects and write them into output txt file
+    :param participants: Pandas DF of the participants.tsv file
     :return:
     """
-    participants = load_participants_file()
     logger.info('Age statistics:')
     # Compute min, max and median for age across all subjects and save it to log
     age_stats = participants['age'].agg(['median', 'min', 'max'])
@@ -532,6 +551,42 @@ def compute_age_statistics():
                                                                               age_stats['median']))
 
 
+@functools.lru_cache(maxsize=None)
+def _get_flag(name):
+    """
+    Read the flag of a country from the folder flags. Cached so each png is decoded once.
+    :param name Name of the country
+    """
+    with importlib.resources.path(spinegeneric.flags, f'{name}.png') as path_flag:
+        return plt.imread(path_flag.__str__())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_rotated_flag(name):
+    """
+    Get the flag of a country rotated by 45 deg for display along the x-axis. Cached separately
+    from the decode: many sites share a country, so each flag is rotated only once, and the raw
+    image stays available should another orientation ever be needed.
+    :param name Name of the country
+    """
+    # bilinear interpolation (order=1, no spline prefilter) is indistinguishable from the
+    # default cubic spline at the small zoom the flags are displayed at, and much cheaper
+    return ndimage.rotate(_get_flag(name), 45, order=1, prefilter=False,
+                          mode='constant', cval=0).clip(0, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_scaled_flag(name):
+    """
+    Get the rotated flag of a country pre-scaled to its display size along the x-axis (the
+    0.18 zoom previously applied by OffsetImage), so blitting it onto the canvas needs no
+    per-site resampling.
+    :param name Name of the country
+    """
+    return ndimage.zoom(_get_rotated_flag(name), (0.18, 0.18, 1),
+                        order=1, prefilter=False).clip(0, 1)
+
+
 def generate_figure_metric(df, metric, stats, display_individual_subjects, show_ci=False):
     """
     Generate bar plot across sites
@@ -543,32 +598,6 @@ def generate_figure_metric(df, metric, stats, display_individual_subjects, show_
     :return:
     """
 
-    def add_flag(coord, name, ax):
-        """
-        Add flag images to the plot.
-        :param coord Coordinate of the xtick
-        :param name Name of the country
-        :param ax Matplotlib ax
-        """
-
-        def _get_flag(name):
-            """
-            Get the flag of a country from the folder flags.
-            :param name Name of the country
-            """
-            with importlib.resources.path(spinegeneric.flags, f'{name}.png') as path_flag:
-                return plt.imread(path_flag.__str__())
-
-        img = _get_flag(name)
-        img_rot = ndimage.rotate(img, 45)
-        im = OffsetImage(img_rot.clip(0, 1), zoom=0.18)
-        im.image.axes = ax
-
-        ab = AnnotationBbox(im, (coord, ax.get_ylim()[0]), frameon=False, pad=0, xycoords='data')
-
-        ax.add_artist(ab)
-        return ax
-
     def label_bar_model(ax, bar_plot, model_lst):
         """
         Add ManufacturersModelName embedded in each bar.
@@ -596,51 +625,46 @@ def generate_figure_metric(df, metric, stats, display_individual_subjects, show_
     std_sorted = df['std'][site_sorted].values
     model_sorted = df['model'][site_sorted].values
 
-    # Scale values (for display)
-    mean_sorted = mean_sorted * scaling_factor[metric]
-    std_sorted = std_sorted * scaling_factor[metric]
+    # Scale values (for display); look the factor up once instead of once per value
+    f = scaling_factor[metric]
+    mean_sorted = mean_sorted * f
+    std_sorted = std_sorted * f
 
     # Get color based on vendor
     list_colors = [vendor_to_color[i] for i in vendor_sorted]
 
     # Create figure and plot bar graph
     # The horizontal size of the figure is proportional to the number of sites
+    # Explicit ax./fig. calls throughout (instead of the pyplot state machine, which does a
+    # gca()/gcf() registry lookup per call and roots the figure globally)
     fig, ax = plt.subplots(figsize=(len(site_sorted) * 0.4, 8))
-    plt.grid(axis='y')
+    ax.grid(axis='y')
     ax.set_axisbelow(True)
-    bar_plot = plt.bar(range(len(site_sorted)), height=mean_sorted, width=0.5,
-                       tick_label=site_sorted, yerr=[[0 for v in std_sorted], std_sorted], color=list_colors)
+    bar_plot = ax.bar(range(len(site_sorted)), height=mean_sorted, width=0.5,
+                      tick_label=site_sorted, yerr=[[0 for v in std_sorted], std_sorted], color=list_colors)
 
     # Display individual subjects
     if display_individual_subjects:
-        for site in site_sorted:
-            index = list(site_sorted).index(site)
-            val = df['val'][site]
-            # Set scaling
-            val = [value * scaling_factor.get(metric) for value in val]
-            plt.plot([index] * len(val), val, 'r.')
+        # enumerate gives the x position directly; list.index() would re-scan site_sorted
+        # for every site
+        for index, site in enumerate(site_sorted):
+            # Set scaling (single vectorized multiply instead of a per-value comprehension)
+            val = np.asarray(df['val'][site]) * f
+            ax.plot(np.full(val.size, index), val, 'r.')
 
     # Deal with xticklabels
     # Rotate xticklabels at 45deg, align at end
     plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, ha="right")
-    plt.xlim([-1, len(site_sorted)])
+    ax.set_xlim([-1, len(site_sorted)])
     # Add space after the site name to allow space for flag
     ax.set_xticklabels([s for s in site_sorted])
     ax.tick_params(labelsize=15)
 
-    # plt.ylim(ylim[contrast])
-    # plt.yticks(np.arange(ylim[contrast][0], ylim[contrast][1], step=ystep[contrast]))
-    plt.ylabel(metric_to_label[metric], fontsize=15)
+    # ax.set_ylim(ylim[contrast])
+    # ax.set_yticks(np.arange(ylim[contrast][0], ylim[contrast][1], step=ystep[contrast]))
+    ax.set_ylabel(metric_to_label[metric], fontsize=15)
     ax.set_ylim(0.3 * mean_sorted.max(), 1.1 * mean_sorted.max())
 
-    # Add country flag of each site
-    for i, c in enumerate(site_sorted):
-        try:
-            ax = add_flag(i, flags[c], ax)
-        except KeyError:
-            logger.error('ERROR: Flag {} is not defined in dict flags'.format(c))
-            sys.exit(1)
-
     # Add ManufacturersModelName embedded in each bar
     ax = label_bar_model(ax, bar_plot, model_sorted)
 
@@ -655,8 +679,10 @@ def generate_figure_metric(df, metric, stats, display_individual_subjects, show_
     # height_bar = [rect.get_height() for idx,rect in enumerate(bar_plot)]
     # y_max = height_bar[i_max]+std_sorted[i_max]  # used to display stats
     y_max = ax.get_ylim()[1] * 95 / 100  # stat will be located at the top 95% of the graph
-    for vendor in list(OrderedDict.fromkeys(vendor_sorted)):
-        n_site = list(vendor_sorted).count(vendor)
+    # count the sites of every vendor in one pass (instead of one list scan per vendor)
+    n_sites_per_vendor = Counter(vendor_sorted)
+    for vendor in pd.unique(vendor_sorted):
+        n_site = n_sites_per_vendor[vendor]
         ax = add_stats_per_vendor(ax=ax,
                                   x_i=x_init_vendor - 0.5,
                                   x_j=x_init_vendor + n_site - 1 + 0.5,
@@ -666,15 +692,32 @@ def generate_figure_metric(df, metric, stats, display_individual_subjects, show_
                                   ci=stats['95ci'][vendor],
                                   cov_intra=stats['cov_intra'][vendor],
                                   cov_inter=stats['cov_inter'][vendor],
-                                  f=scaling_factor[metric],
+                                  f=f,
                                   color=list_colors[x_init_vendor],
                                   show_ci=show_ci)
         x_init_vendor += n_site
 
+    fig.tight_layout()
+
+    # Add the country flag of each site, blitted straight onto the canvas (fig.figimage)
+    # instead of one AnnotationBbox artist per site that the renderer has to walk on every
+    # draw. Done after tight_layout, once the data-to-pixel transform is final.
+    fig.canvas.draw()
+    y_flag = ax.get_ylim()[0]
+    for i, site in enumerate(site_sorted):
+        try:
+            img = _get_scaled_flag(flags[site])
+        except KeyError:
+            logger.error('ERROR: Flag {} is not defined in dict flags'.format(site))
+            sys.exit(1)
+        x_pix, y_pix = ax.transData.transform((i, y_flag))
+        fig.figimage(img, xo=x_pix - img.shape[1] / 2, yo=y_pix - img.shape[0] / 2, zorder=10)
+
     # Save figure
-    plt.tight_layout()
     fname_fig = os.path.join('fig_' + metric + '.png')
-    plt.savefig(fname_fig)
+    fig.savefig(fname_fig)
+    # free the canvas and every artist it roots (pyplot keeps figures alive otherwise)
+    plt.close(fig)
     logger.info('Created: ' + fname_fig)
 
 
@@ -703,20 +746,16 @@ def generate_figure_metric_plotly(df, metric, stats):
     fig = go.Figure()
 
     # Display individual subjects
-    i = 0
+    f = scaling_factor[metric]
     for site in site_sorted:
-        index = list(site_sorted).index(site)
-        val = df['val'][site]
-        val = [value * scaling_factor.get(metric) for value in val]
-        x = site_sorted[i]
+        val = np.asarray(df['val'][site]) * f
         fig.add_trace(go.Scatter(
-            x=[x, x, x, x, x, x], 
-            y=val, 
-            mode='markers', 
-            marker_color='red', 
-            name=x
+            x=[site] * val.size,
+            y=val,
+            mode='markers',
+            marker_color='red',
+            name=site
         ))
-        i = i + 1
     fig.update_traces(marker=dict(size=4))
 
     fig.add_trace(go.Bar(
@@ -734,8 +773,9 @@ def generate_figure_metric_plotly(df, metric, stats):
 
     # Add stats per vendor
     x_init_vendor = 0
-    for vendor in list(OrderedDict.fromkeys(vendor_sorted)):
-        n_site = list(vendor_sorted).count(vendor)
+    n_sites_per_vendor = Counter(vendor_sorted)
+    for vendor in pd.unique(vendor_sorted):
+        n_site = n_sites_per_vendor[vendor]
         x_i=x_init_vendor - 0.5
         x_j=x_init_vendor + n_site - 1 + 0.5
         mean=stats['mean'][vendor]
@@ -743,7 +783,6 @@ def generate_figure_metric_plotly(df, metric, stats):
         ci=stats['95ci'][vendor]
         cov_intra=stats['cov_intra'][vendor]
         cov_inter=stats['cov_inter'][vendor]
-        f=scaling_factor[metric]
         color=list_colors[x_init_vendor]
 
         fig.add_trace(go.Scatter(
@@ -770,12 +809,35 @@ def generate_figure_metric_plotly(df, metric, stats):
     fig.write_html(metric+'.html')
 
 
-def generate_figure_t1_t2(df, csa_t1, csa_t2):
+def build_csa_dict(df_t1, df_t2):
+    """
+    Pair the within-subject T1w and T2w CSA values, per vendor. Only subjects that have both a
+    T1w and a T2w value are kept.
+    :param df_t1: aggregated per-site DataFrame for csa_t1 (as output by aggregate_per_site)
+    :param df_t2: aggregated per-site DataFrame for csa_t2
+    :return: dict with keys '<vendor>_t1' and '<vendor>_t2' mapping to numpy arrays
+    """
+    def flatten(df, name):
+        # one row per (site, subject) pair; the subject and val lists are parallel by construction
+        flat = df.sort_values('site')[['vendor', 'subject', 'val']].explode(['subject', 'val'])
+        return flat.rename(columns={'val': name})
+
+    # hashed inner merge on subject, instead of one linear list scan per subject
+    merged = flatten(df_t1, 'val_t1').merge(flatten(df_t2, 'val_t2')[['subject', 'val_t2']],
+                                            on='subject', how='inner')
+    CSA_dict = defaultdict(lambda: np.empty(0))
+    for vendor, group in merged.groupby('vendor', sort=False):
+        CSA_dict[vendor + '_t1'] = group['val_t1'].to_numpy(dtype=np.float64)
+        CSA_dict[vendor + '_t2'] = group['val_t2'].to_numpy(dtype=np.float64)
+    return CSA_dict
+
+
+def generate_figure_t1_t2(df, df_t1, df_t2):
     """
     Generate CSA_T1w vs. CSA_T2w
     :param df:
-    :param csa_t1:
-    :param csa_t2:
+    :param df_t1: aggregated per-site DataFrame for csa_t1
+    :param df_t2: aggregated per-site DataFrame for csa_t2
     :return:
     """
 
@@ -783,21 +845,17 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
         """
         Compute linear regression between x and y:
         y = Slope * x + Intercept
-        :param x: list:
-        :param y: list:
+        :param x: numpy 1d array
+        :param y: numpy 1d array
         :return: results of linear regression
         """
-        # create object for the class
-        linear_regression = LinearRegression()
-        # perform linear regression (compute slope and intercept)
-        linear_regression.fit(x.reshape(-1, 1), y.reshape(-1, 1))
-        intercept = linear_regression.intercept_
-        slope = linear_regression.coef_
-        # compute prediction
-        reg_predictor = linear_regression.predict(x)
-        # compute coefficient of determination R^2 of the prediction
-        r2_sc = linear_regression.score(x, y)
-        return intercept, slope, reg_predictor, r2_sc
+        # linregress solves the 1d fit directly: no estimator object, no column-vector
+        # reshaping, and slope/intercept come back as plain floats
+        result = linregress(x, y)
+        reg_predictor = result.intercept + result.slope * x
+        # coefficient of determination R^2
+        r2_sc = result.rvalue ** 2
+        return result.intercept, result.slope, reg_predictor, r2_sc
 
     def format_number(number):
         """
@@ -812,56 +870,55 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
     vendor_sorted = df['vendor'][site_sorted].values
 
     # Create dictionary with CSA for T1w and T2w per vendors
-    CSA_dict = defaultdict(list)
-    # loop across sites
-    for index, line in enumerate(csa_t1):
-        vendor = line[1]
-        # Loop across subjects, making sure to only populate the dictionary with subjects existing both for T1 and T2
-        for subject in csa_t1[index][4]:
-            if subject in csa_t2[index, 4]:
-                CSA_dict[vendor + '_t1'].append(csa_t1[index, 3][csa_t1[index, 4].index(subject)])
-                CSA_dict[vendor + '_t2'].append(csa_t2[index, 3][csa_t2[index, 4].index(subject)])
+    CSA_dict = build_csa_dict(df_t1, df_t2)
 
     # Generate figure for T1w and T2w agreement for all vendors together
     fig, ax = plt.subplots(figsize=(7, 7))
     # Loop across vendors
-    for vendor in list(OrderedDict.fromkeys(vendor_sorted)):
-        plt.scatter(CSA_dict[vendor + '_t2'],
-                    CSA_dict[vendor + '_t1'],
-                    s=50,
-                    linewidths=2,
-                    facecolors='none',
-                    edgecolors=vendor_to_color[vendor],
-                    label=vendor)
+    for vendor in pd.unique(vendor_sorted):
+        ax.scatter(CSA_dict[vendor + '_t2'],
+                   CSA_dict[vendor + '_t1'],
+                   s=50,
+                   linewidths=2,
+                   facecolors='none',
+                   edgecolors=vendor_to_color[vendor],
+                   label=vendor,
+                   rasterized=True)
     ax.tick_params(labelsize=LABELSIZE)
-    plt.plot([50, 100], [50, 100], ls="--", c=".3")  # add diagonal line
-    plt.title("CSA agreement between T1w and T2w data")
-    plt.xlim(50, 100)
-    plt.ylim(50, 100)
-    plt.gca().set_aspect('equal', adjustable='box')
-    plt.xlabel("T2w CSA", fontsize=FONTSIZE)
-    plt.ylabel("T1w CSA", fontsize=FONTSIZE)
-    plt.grid(True)
-    plt.legend(fontsize=FONTSIZE)
-    plt.tight_layout()
+    ax.plot([50, 100], [50, 100], ls="--", c=".3")  # add diagonal line
+    ax.set_title("CSA agreement between T1w and T2w data")
+    ax.set_xlim(50, 100)
+    ax.set_ylim(50, 100)
+    ax.set_aspect('equal', adjustable='box')
+    ax.set_xlabel("T2w CSA", fontsize=FONTSIZE)
+    ax.set_ylabel("T1w CSA", fontsize=FONTSIZE)
+    ax.grid(True)
+    ax.legend(fontsize=FONTSIZE)
+    fig.tight_layout()
     fname_fig = 'fig_t1_t2_agreement.png'
-    plt.savefig(fname_fig, dpi=200)
+    fig.savefig(fname_fig, dpi=200)
+    plt.close(fig)
     logger.info('Created: ' + fname_fig)
 
     # Generate figure for T1w and T2w agreement per vendor
-    plt.subplots(figsize=(15, 5))
+    fig = plt.figure(figsize=(15, 5))
     # Loop across vendors (create subplot for each vendor)
-    for index, vendor in enumerate(list(OrderedDict.fromkeys(vendor_sorted))):
-        ax = plt.subplot(1, 3, index + 1)
-        x = CSA_dict[vendor + '_t2']
-        y = CSA_dict[vendor + '_t1']
-        plt.scatter(x,
-                    y,
-                    s=50,
-                    linewidths=2,
-                    facecolors='none',
-                    edgecolors=vendor_to_color[vendor],
-                    label=vendor)
+    for index, vendor in enumerate(pd.unique(vendor_sorted)):
+        ax = fig.add_subplot(1, 3, index + 1)
+        # materialize the value arrays once per vendor; they are reused by the scatter plot,
+        # the axis limits and the linear fit below
+        x = np.asarray(CSA_dict[vendor + '_t2'])
+        y = np.asarray(CSA_dict[vendor + '_t1'])
+        # rasterized keeps the many markers as a bitmap if the figure is ever saved to a
+        # vector format (no-op for the png output)
+        ax.scatter(x,
+                   y,
+                   s=50,
+                   linewidths=2,
+                   facecolors='none',
+                   edgecolors=vendor_to_color[vendor],
+                   label=vendor,
+                   rasterized=True)
         ax.tick_params(labelsize=TICKSIZE)
         # Define vendor name position
         legend = ax.legend(loc='lower right', handletextpad=0, fontsize=FONTSIZE)
@@ -871,54 +928,51 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
         ax.add_artist(legend)
         # Dynamic scaling of individual subplots based on data
         offset = 2
-        lim_min = min(min(x), min(y))
-        lim_max = max(max(x), max(y))
-        plt.xlim(lim_min - offset, lim_max + offset)
-        plt.ylim(lim_min - offset, lim_max + offset)
+        lim_min = min(x.min(), y.min())
+        lim_max = max(x.max(), y.max())
+        ax.set_xlim(lim_min - offset, lim_max + offset)
+        ax.set_ylim(lim_min - offset, lim_max + offset)
         # Add bisection (diagonal) line
-        plt.plot([lim_min - offset, lim_max + offset],
-                 [lim_min - offset, lim_max + offset],
-                 ls="--", c=".3")
-        plt.xlabel("T2w CSA", fontsize=FONTSIZE)
-        plt.ylabel("T1w CSA", fontsize=FONTSIZE)
+        ax.plot([lim_min - offset, lim_max + offset],
+                [lim_min - offset, lim_max + offset],
+                ls="--", c=".3")
+        ax.set_xlabel("T2w CSA", fontsize=FONTSIZE)
+        ax.set_ylabel("T1w CSA", fontsize=FONTSIZE)
         # Move grid to background (i.e. behind other elements)
         ax.set_axisbelow(True)
-        plt.grid(True)
+        ax.grid(True)
         # Enforce square grid
-        plt.gca().set_aspect('equal', adjustable='box')
+        ax.set_aspect('equal', adjustable='box')
         # Compute linear fit
-        intercept, slope, reg_predictor, r2_sc = \
-            compute_regression(np.array(CSA_dict[vendor + '_t2']).reshape(-1, 1),
-                               np.array(CSA_dict[vendor + '_t1']).reshape(-1, 1))
+        intercept, slope, reg_predictor, r2_sc = compute_regression(x, y)
         # Place regression equation to upper-left corner
-        plt.text(0.1, 0.9, 'y = {}x + {}\nR\u00b2 = {}'.format(format_number(slope),
-                                                               format_number(intercept),
-                                                               format_number(r2_sc)),
-                 ha='left', va='center', transform=ax.transAxes, fontsize=TICKSIZE, color='red',
-                 bbox=dict(boxstyle='round', facecolor='white', alpha=1))  # box around equation
+        ax.text(0.1, 0.9, 'y = {}x + {}\nR\u00b2 = {}'.format(format_number(slope),
+                                                              format_number(intercept),
+                                                              format_number(r2_sc)),
+                ha='left', va='center', transform=ax.transAxes, fontsize=TICKSIZE, color='red',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=1))  # box around equation
         # Plot linear fit
-        axes = plt.gca()
-        x_vals = np.array(axes.get_xlim())
+        x_vals = np.array(ax.get_xlim())
         y_vals = intercept + slope * x_vals
-        y_vals = np.squeeze(y_vals)  # change shape from (1,N) to (N,)
-        plt.plot(x_vals, y_vals, color='red')
+        ax.plot(x_vals, y_vals, color='red')
         # Add title above middle subplot
         if index == 1:
-            plt.title("CSA agreement between T1w and T2w data per vendors", fontsize=FONTSIZE, pad=20)
+            ax.set_title("CSA agreement between T1w and T2w data per vendors", fontsize=FONTSIZE, pad=20)
     # Move subplots closer to each other
-    plt.subplots_adjust(wspace=-0.5)
-    plt.tight_layout()
+    fig.subplots_adjust(wspace=-0.5)
+    fig.tight_layout()
     fname_fig = 'fig_t1_t2_agreement_per_vendor.png'
-    plt.savefig(fname_fig, dpi=200)
+    fig.savefig(fname_fig, dpi=200)
+    plt.close(fig)
     logger.info('Created: ' + fname_fig)
 
 
-def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
+def generate_figure_t1_t2_plotly(df, df_t1, df_t2):
     """
     Generate inteactive CSA_T1w vs. CSA_T2w figure
     :param df:
-    :param csa_t1:
-    :param csa_t2:
+    :param df_t1: aggregated per-site DataFrame for csa_t1
+    :param df_t2: aggregated per-site DataFrame for csa_t2
     :return:
     """
 
@@ -927,19 +981,11 @@ def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
     vendor_sorted = df['vendor'][site_sorted].values
 
     # Create dictionary with CSA for T1w and T2w per vendors
-    CSA_dict = defaultdict(list)
-    # loop across sites
-    for index, line in enumerate(csa_t1):
-        vendor = line[1]
-        # Loop across subjects, making sure to only populate the dictionary with subjects existing both for T1 and T2
-        for subject in csa_t1[index][4]:
-            if subject in csa_t2[index, 4]:
-                CSA_dict[vendor + '_t1'].append(csa_t1[index, 3][csa_t1[index, 4].index(subject)])
-                CSA_dict[vendor + '_t2'].append(csa_t2[index, 3][csa_t2[index, 4].index(subject)])
-    
+    CSA_dict = build_csa_dict(df_t1, df_t2)
+
     fig_v = go.Figure()
     # Loop across vendors
-    for vendor in list(OrderedDict.fromkeys(vendor_sorted)):
+    for vendor in pd.unique(vendor_sorted):
         fig_v.add_trace(go.Scatter(
             x=CSA_dict[vendor + '_t2'],
             y=CSA_dict[vendor + '_t1'],
@@ -968,7 +1014,7 @@ def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
     fig_2 = make_subplots(rows=1, cols=3)
     i = 1
     # Loop across vendors (create subplot for each vendor)
-    for index, vendor in enumerate(list(OrderedDict.fromkeys(vendor_sorted))):
+    for index, vendor in enumerate(pd.unique(vendor_sorted)):
         x = CSA_dict[vendor + '_t2']
         y = CSA_dict[vendor + '_t1']
         fig_2.add_trace(
@@ -1000,18 +1046,14 @@ def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
             row=1, col=i
         )
 
-        # Compute linear fit
-        linear_regression = LinearRegression()
-        # perform linear regression (compute slope and intercept)
-        linear_regression.fit((np.array(x).reshape(-1, 1)).reshape(-1, 1), (np.array(y).reshape(-1, 1)).reshape(-1, 1))
-        intercept = linear_regression.intercept_
-        slope = linear_regression.coef_
-        # compute prediction
-        reg_predictor = linear_regression.predict(np.array(x).reshape(-1, 1))
+        # Compute linear fit (compute slope and intercept)
+        result = linregress(np.asarray(x), np.asarray(y))
+        intercept = result.intercept
+        slope = result.slope
 
         # Plot linear fit
         x_vals = np.linspace(50, 100, 50)
-        y_vals = np.squeeze(intercept + (slope * x_vals))
+        y_vals = intercept + slope * x_vals
         fig_2.add_trace(go.Scatter(
                 x=x_vals, 
                 y=y_vals, 
@@ -1024,49 +1066,30 @@ def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
     fig_2.write_html("fig_t1_t2_agreement_per_vendor.html")
 
 
+# matches 'KEY=VALUE' and 'export KEY=VALUE' lines of a shell script
+_ENV_LINE = re.compile(r'^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*?)\s*$')
+
+
 def get_env(file_param):
     """
-    Get shell environment variables from a shell script.
-    Source: https://stackoverflow.com/a/19431112
+    Get shell environment variables declared in a shell script.
+    The script is parsed directly (KEY=VALUE and 'export KEY=VALUE' lines), without forking a
+    shell just to source it and diff two full environment dumps. Shell substitutions inside the
+    values are not evaluated.
     :param file_param:
     :return: env: dictionary of all environment variables declared in the shell script
     """
     logger.debug("\nFetch environment variables from file: {}".format(file_param))
     env = {}
-    p = subprocess.Popen('env', stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    oldEnv = p.communicate()[0].decode('utf-8')
-    p = subprocess.Popen('source {} ; env'.format(file_param), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                         shell=True)
-    newEnv = p.communicate()[0].decode('utf-8')
-    for newStr in newEnv.split('\n'):
-        flag = True
-        for oldStr in oldEnv.split('\n'):
-            if newStr == oldStr:
-                # not exported by setenv.sh
-                flag = False
-                break
-        if flag:
-            # exported by setenv.sh
-            logger.debug("  {}".format(newStr))
-            # add to dictionary
-            env[newStr.split('=')[0]] = newStr.split('=')[1]
+    with open(file_param) as fh:
+        for line in fh:
+            match = _ENV_LINE.match(line)
+            if match:
+                logger.debug("  {}".format(match.group(0).strip()))
+                env[match.group(1)] = match.group(2).strip('"\'')
     return env
 
 
-def remove_subject(subject, metric, dict_exclude_subj):
-    """
-    Check if subject should be removed
-    :param subject:
-    :param metric:
-    :param dict_exclude_subj:
-    :return: Bool
-    """
-    if metric in dict_exclude_subj.keys():
-        if subject in dict_exclude_subj[metric]:
-            return True
-    return False
-
-
 def main(argv=sys.argv[1:]):
     parser = get_parser()
     args = parser.parse_args(argv)
@@ -1089,6 +1112,10 @@ def main(argv=sys.argv[1:]):
                 dict_exclude_subj = yaml.safe_load(stream)
             except yaml.YAMLError as exc:
                 logger.error(exc)
+        # freeze the per-metric exclusion lists once: every later lookup is then a hashed
+        # membership test, whatever the yml listed (and duplicates collapse for free)
+        dict_exclude_subj = {metric: frozenset(entries or ())
+                             for metric, entries in dict_exclude_subj.items()}
     else:
         # initialize empty dict if no config yml file is passed
         dict_exclude_subj = dict()
@@ -1106,10 +1133,14 @@ def main(argv=sys.argv[1:]):
     fh = logging.FileHandler(os.path.join(os.path.abspath(os.curdir), FNAME_LOG))
     logging.root.addHandler(fh)
 
+    # Build Panda DF of participants based on participants.tsv file, once for all metrics
+    participants = load_participants_file()
+
     # Compute age statistics and write them at the beginning of output txt file
-    compute_age_statistics()
+    compute_age_statistics(participants)
 
     # loop across individual *.csv files and generate figures and compute statistics
+    figure_jobs = []
     for csv_file in file_to_metric.keys():
 
         # skip metric, if *.csv file does not exist
@@ -1117,33 +1148,27 @@ def main(argv=sys.argv[1:]):
             logger.info('\n{} file is missing. Skipping to the next metric.'.format(csv_file))
             continue
 
-        # Open CSV file and create dict
-        logger.info("\n{}\n====================================================".format(csv_file))
-        dict_results = []
-        with open(csv_file, newline='') as f_csv:
-            reader = csv.DictReader(f_csv)
-            for row in reader:
-                dict_results.append(row)
-
         # Fetch metric name
         _, csv_file_small = os.path.split(csv_file)
         metric = file_to_metric[csv_file_small]
 
-        # Fetch mean, std, etc. per site
-        results_dict = aggregate_per_site(dict_results, metric, dict_exclude_subj)
+        # Open CSV file with the pandas C parser; usecols restricts the parse (and the memory
+        # footprint) to the two columns the aggregation reads
+        logger.info("\n{}\n====================================================".format(csv_file))
+        df_csv = pd.read_csv(csv_file, usecols=['Filename', metric_to_field[metric]])
 
-        # Make it a pandas structure (easier for manipulations)
-        df = pd.DataFrame.from_dict(results_dict, orient='index')
+        # Fetch mean, std, etc. per site as a pandas structure (easier for manipulations)
+        df = aggregate_per_site(df_csv, metric, dict_exclude_subj, participants)
 
-        # Add column to DF with excluded sites
+        # Add column to DF with excluded sites (entries not starting with 'sub-' are sites),
+        # flagged with a single vectorized write instead of one chained assignment per site
         df['exclude'] = False
         if metric in dict_exclude_subj.keys():
-            for subject in dict_exclude_subj[metric]:
-                if not subject.startswith('sub-'):
-                    df['exclude'][subject] = True
+            excluded_sites = [site for site in dict_exclude_subj[metric] if not site.startswith('sub-')]
+            df.loc[df.index.isin(excluded_sites), 'exclude'] = True
 
         # Excluded sites
-        logger.info('Sites removed: {}'.format(list(df[df['exclude'] == True]['site'].values)))
+        logger.info('Sites removed: {}'.format(list(df.index[df['exclude']])))
 
         # Compute statistics
         df, stats = compute_statistics(df)
@@ -1152,8 +1177,9 @@ def main(argv=sys.argv[1:]):
         if args.output_text:
             output_text(stats)
 
-        # Generate figure
-        generate_figure_metric(df, metric, stats, display_individual_subjects, show_ci=args.show_ci)
+        # Defer figure generation: collect the inputs here and render all the figures below,
+        # where the independent metrics can be processed in parallel
+        figure_jobs.append((df, metric, stats))
 
         if args.output_html:
             # Generate interactive html figure
@@ -1161,16 +1187,30 @@ def main(argv=sys.argv[1:]):
 
         # Get T1w and T2w CSA (will be used later for another figure)
         if metric == "csa_t1":
-            csa_t1 = df.sort_values('site').values
+            df_t1 = df
         elif metric == "csa_t2":
-            csa_t2 = df.sort_values('site').values
+            df_t2 = df
+
+    # Generate the per-metric figures. Rendering is CPU-bound and independent across metrics, so
+    # farm it out to worker processes; keep it serial in debug mode, where figures are interactive.
+    if args.v or len(figure_jobs) <= 1:
+        for df_job, metric_job, stats_job in figure_jobs:
+            generate_figure_metric(df_job, metric_job, stats_job, display_individual_subjects, show_ci=args.show_ci)
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(figure_jobs), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(generate_figure_metric, df_job, metric_job, stats_job,
+                                       display_individual_subjects, args.show_ci)
+                       for df_job, metric_job, stats_job in figure_jobs]
+            # propagate exceptions (and wait for all figures) before moving on
+            for future in futures:
+                future.result()
 
     # Generate T1w vs. T2w figure
-    generate_figure_t1_t2(df, csa_t1, csa_t2)
+    generate_figure_t1_t2(df, df_t1, df_t2)
 
     if args.output_html:
         # Generate interactive html T1w vs. T2w figure
-        generate_figure_t1_t2_plotly(df, csa_t1, csa_t2)
+        generate_figure_t1_t2_plotly(df, df_t1, df_t2)
 
 
 if __name__ == "__main__":
@@ -11,11 +11,20 @@ import argparse
 import coloredlogs
 import json
 import os
+import subprocess
 import sys
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 import time
 import yaml
+try:
+    # Use the LibYAML C extension when available (much faster than the pure-Python loader).
+    # The FILES_* schema is a plain mapping of string lists, so tag resolution is not needed:
+    # CBaseLoader returns every scalar as str and skips the resolver/constructor dispatches.
+    from yaml import CBaseLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 import spinegeneric as sg
 import spinegeneric.utils
@@ -24,7 +33,7 @@ import spinegeneric.bids
 
 # Folder where to output manual labels, at the root of a BIDS dataset.
 # TODO: make it an input argument (with default value)
-FOLDER_DERIVATIVES = os.path.join('derivatives', 'labels')
+FOLDER_DERIVATIVES = sg.utils.FOLDER_DERIVATIVES
 
 
 def get_parser():
@@ -79,6 +88,14 @@ def get_parser():
              "Skip the copy of the source files, and the opening of the manual correction pop-up windows.",
         action='store_true'
     )
+    parser.add_argument(
+        '-workers',
+        metavar=sg.utils.Metavar.int,
+        type=int,
+        default=1,
+        help="Number of parallel workers used to generate the QC reports once the corrections are done. "
+             "Useful with large yml files. Default: 1 (serial)."
+    )
     parser.add_argument(
         '-v', '--verbose',
         help="Full verbose (for debugging)",
@@ -121,7 +138,8 @@ def correct_segmentation(fname, fname_seg_out):
     """
     # launch FSLeyes
     print("In FSLeyes, click on 'Edit mode', correct the segmentation, then save it with the same name (overwrite).")
-    os.system('fsleyes -yh ' + fname + ' ' + fname_seg_out + ' -cm red')
+    # subprocess (vs. os.system) skips the intermediate shell and is robust to spaces in paths
+    subprocess.run(['fsleyes', '-yh', fname, fname_seg_out, '-cm', 'red'], check=False)
 
 
 def correct_vertebral_labeling(fname, fname_label):
@@ -133,7 +151,8 @@ def correct_vertebral_labeling(fname, fname_label):
     :return:
     """
     message = "Click inside the spinal cord, at C3 and C5 mid-vertebral levels, then click 'Save and Quit'."
-    os.system('sct_label_utils -i {} -create-viewer 3,5 -o {} -msg {}'.format(fname, fname_label, message))
+    subprocess.run(['sct_label_utils', '-i', fname, '-create-viewer', '3,5', '-o', fname_label, '-msg', message],
+                   check=False)
 
 
 def create_json(fname_nifti, name_rater):
@@ -144,7 +163,12 @@ def create_json(fname_nifti, name_rater):
     :return:
     """
     metadata = {'Author': name_rater, 'Date': time.strftime('%Y-%m-%d %H:%M:%S')}
-    fname_json = fname_nifti.rstrip('.nii').rstrip('.nii.gz') + '.json'
+    # Note: rstrip strips *characters*, not a suffix, so it could eat into the file stem;
+    # slice the literal extension off instead (cheaper, and correct)
+    if fname_nifti.endswith('.nii.gz'):
+        fname_json = fname_nifti[:-len('.nii.gz')] + '.json'
+    else:
+        fname_json = os.path.splitext(fname_nifti)[0] + '.json'
     with open(fname_json, 'w') as outfile:
         json.dump(metadata, outfile, indent=4)
 
@@ -166,18 +190,23 @@ def main():
         if not sg.utils.check_software_installed():
             sys.exit("Some required software are not installed. Exit program.")
 
-    # check if input yml file exists
-    if os.path.isfile(args.config):
-        fname_yml = args.config
-    else:
-        sys.exit("ERROR: Input yml file {} does not exist or path is wrong.".format(args.config))
-
-    # fetch input yml file as dict
-    with open(fname_yml, 'r') as stream:
-        try:
-            dict_yml = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
+    # fetch input yml file as dict. Open it directly instead of isfile+open (which would stat
+    # the file twice) and fail with the same error message if it is missing.
+    fname_yml = args.config
+    try:
+        stream = open(fname_yml, 'r')
+    except (FileNotFoundError, IsADirectoryError):
+        sys.exit("ERROR: Input yml file {} does not exist or path is wrong.".format(fname_yml))
+    with stream:
+        if fname_yml.endswith('.json'):
+            # json configs with the same schema are accepted as well (json parses faster than
+            # yaml, which can matter for configs listing thousands of files)
+            dict_yml = json.load(stream)
+        else:
+            try:
+                dict_yml = yaml.load(stream, Loader=YamlLoader)
+            except yaml.YAMLError as exc:
+                print(exc)
 
     # check for missing files before starting the whole process
     sg.utils.check_files_exist(dict_yml, args.path_in)
@@ -194,48 +223,79 @@ def main():
     fname_qc = 'qc_corr_' + time.strftime('%Y%m%d%H%M%S')
 
     # TODO: address "none" issue if no file present under a key
-    # Perform manual corrections
-    for task, files in dict_yml.items():
-        if files is not None:
-            for file in files:
-                # build file names
-                subject = sg.bids.get_subject(file)
-                contrast = sg.bids.get_contrast(file)
-                fname = os.path.join(args.path_in, subject, contrast, file)
-                fname_label = os.path.join(
-                    path_out_deriv, subject, contrast, sg.utils.add_suffix(file, get_suffix(task, '-manual')))
-                os.makedirs(os.path.join(path_out_deriv, subject, contrast), exist_ok=True)
-                if not args.qc_only:
-                    if os.path.isfile(fname_label):
-                        # if corrected file already exists, asks user if they want to overwrite it
-                        answer = None
-                        while answer not in ("y", "n"):
-                            answer = input("WARNING! The file {} already exists. "
-                                           "Would you like to overwrite it? [y/n] ".format(fname_label))
-                            if answer == "y":
-                                do_labeling = True
-                            elif answer == "n":
-                                do_labeling = False
-                            else:
-                                print("Please answer with 'y' or 'n'")
-                    else:
-                        do_labeling = True
-                    # Perform labeling for the specific task
-                    if do_labeling:
-                        if task in ['FILES_SEG', 'FILES_GMSEG']:
-                            fname_seg = sg.utils.add_suffix(fname, get_suffix(task))
-                            shutil.copy(fname_seg, fname_label)
-                            correct_segmentation(fname, fname_label)
-                        elif task == 'FILES_LABEL':
-                            correct_vertebral_labeling(fname, fname_label)
+    # Resolve subject/contrast once per file, in a single pass over the config
+    files_per_task = {task: [(file, sg.bids.get_subject(file), sg.bids.get_contrast(file)) for file in files]
+                      for task, files in dict_yml.items() if files is not None}
+
+    # Create the output folders upfront: one makedirs per unique subject/contrast folder,
+    # instead of one stat+mkdir per file inside the correction loop
+    paths_out = {os.path.join(path_out_deriv, subject, contrast)
+                 for files in files_per_task.values() for _, subject, contrast in files}
+    for path_out in paths_out:
+        os.makedirs(path_out, exist_ok=True)
+
+    # Perform manual corrections. QC commands are collected along the way and run after the
+    # interactive loop, where they can be parallelized (see -workers).
+    qc_commands = []
+    for task, files in files_per_task.items():
+        # hoist the per-task lookups out of the per-file loop (they only depend on the task)
+        suffix_seg = get_suffix(task)
+        suffix_label = get_suffix(task, '-manual')
+        qc_function = get_function(task)
+        path_in = args.path_in
+        for file, subject, contrast in files:
+            # build file names
+            fname = os.path.join(path_in, subject, contrast, file)
+            fname_label = os.path.join(
+                path_out_deriv, subject, contrast, sg.utils.add_suffix(file, suffix_label))
+            if not args.qc_only:
+                if os.path.isfile(fname_label):
+                    # if corrected file already exists, asks user if they want to overwrite it
+                    answer = None
+                    while answer not in ("y", "n"):
+                        answer = input("WARNING! The file {} already exists. "
+                                       "Would you like to overwrite it? [y/n] ".format(fname_label))
+                        if answer == "y":
+                            do_labeling = True
+                        elif answer == "n":
+                            do_labeling = False
                         else:
-                            sys.exit('Task not recognized from yml file: {}'.format(task))
-                        # create json sidecar with the name of the expert rater
-                        create_json(fname_label, name_rater)
-
-                # generate QC report
-                os.system('sct_qc -i {} -s {} -p {} -qc {} -qc-subject {}'.format(
-                    fname, fname_label, get_function(task), fname_qc, subject))
+                            print("Please answer with 'y' or 'n'")
+                else:
+                    do_labeling = True
+                # Perform labeling for the specific task
+                if do_labeling:
+                    if task in ['FILES_SEG', 'FILES_GMSEG']:
+                        fname_seg = sg.utils.add_suffix(fname, suffix_seg)
+                        # copyfile (instead of copy) skips the copymode stat+chmod and lets the
+                        # OS fast-path (e.g. sendfile) kick in, which matters for large volumes.
+                        # Attempt the copy directly (instead of isfile+copy, which stats twice)
+                        # and skip the file if the source segmentation is missing.
+                        try:
+                            shutil.copyfile(fname_seg, fname_label)
+                        except FileNotFoundError:
+                            print("File {} does not exist. Skipping.".format(fname_seg))
+                            continue
+                        correct_segmentation(fname, fname_label)
+                    elif task == 'FILES_LABEL':
+                        correct_vertebral_labeling(fname, fname_label)
+                    else:
+                        sys.exit('Task not recognized from yml file: {}'.format(task))
+                    # create json sidecar with the name of the expert rater
+                    create_json(fname_label, name_rater)
+
+            # generate QC report (deferred)
+            qc_commands.append(['sct_qc', '-i', fname, '-s', fname_label, '-p', qc_function,
+                                '-qc', fname_qc, '-qc-subject', subject])
+
+    # Generate QC reports. These are non-interactive subprocess calls, so they can run in
+    # parallel when the user asks for it.
+    if args.workers > 1:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(lambda cmd: subprocess.run(cmd, check=False), qc_commands))
+    else:
+        for cmd in qc_commands:
+            subprocess.run(cmd, check=False)
 
     # Archive QC folder
     shutil.copy(fname_yml, fname_qc)
@@ -95,14 +95,14 @@ def main():
     else:
         coloredlogs.install(fmt='%(message)s', level='INFO')
 
-    # Check if input yml file exists
-    if os.path.isfile(args.config):
-        fname_yml = args.config
-    else:
-        sys.exit("ERROR: Input yml file {} does not exist or path is wrong.".format(args.config))
-
-    # Fetch input yml file as dict
-    with open(fname_yml, 'r') as stream:
+    # Fetch input yml file as dict. Open it directly instead of isfile+open (which would stat
+    # the file twice) and fail with the same error message if it is missing.
+    fname_yml = args.config
+    try:
+        stream = open(fname_yml, 'r')
+    except (FileNotFoundError, IsADirectoryError):
+        sys.exit("ERROR: Input yml file {} does not exist or path is wrong.".format(fname_yml))
+    with stream:
         try:
             dict_yml = yaml.safe_load(stream)
         except yaml.YAMLError as exc:
@@ -60,11 +60,13 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
 
-    folder_derivatives = os.path.join('derivatives', 'labels')
+    folder_derivatives = sg.utils.FOLDER_DERIVATIVES
     path_dataset = args.path_out
 
     files = glob.glob('*.nii.gz')
 
+    # keep track of already-created output folders to avoid one makedirs stat per file
+    paths_created = set()
     for file in files:
         # get subject
         subject = file.split('_')[0]
@@ -76,11 +78,14 @@ def main():
         else:
             folder_contrast = 'anat'
         path_output = os.path.join(path_output, folder_contrast)
-        os.makedirs(path_output, exist_ok=True)
-        # copy
+        if path_output not in paths_created:
+            os.makedirs(path_output, exist_ok=True)
+            paths_created.add(path_output)
+        # copy (to the explicit destination path, so shutil does not need to stat the
+        # destination to figure out it is a directory)
         file_out = os.path.join(path_output, file)
         print("{} -> {}".format(file, path_output+os.path.sep))
-        shutil.copy(file, path_output)
+        shutil.copy(file, file_out)
 
 
 if __name__ == "__main__":
@@ -69,14 +69,11 @@ part5 = '''  alt="T2w defaced" />
 
 final_qc = part1
 
-list_images = os.listdir(path_data)
-list_subjects = []
-for item in list_images:
-    subject = (item.split("_")[0])
-    if subject not in list_subjects:
-        list_subjects.append(subject)
-        
-list_subjects.sort()        
+# stream the directory with scandir (no full-listing allocation) and deduplicate subjects
+# with a set instead of a per-item linear scan of the list
+with os.scandir(path_data) as it:
+    list_subjects = sorted({entry.name.split("_")[0] for entry in it})
+
 for subject in list_subjects:
     final_qc += part2+subject
     final_qc += part3+'./'+subject+'_T1w.png"'